@@ -5,9 +5,73 @@ from PySide6.QtGui import QAction, QKeySequence, QCloseEvent, QIcon, QImage
 from PySide6.QtWidgets import QMainWindow, QMessageBox, QLabel, QApplication, QFileDialog, QToolBar
 
 import numpy as np
+import sys
 
 DEVICE_LOST_EVENT = QEvent.Type(QEvent.Type.User + 1)
-    
+
+
+class FramePool:
+    # Reusable frame arrays for the camera thread. A frame is only written to again
+    # once no consumer holds a reference to it anymore, so receivers may keep frames.
+    # Consumers that only keep the frame's memory, e.g. a QImage over frame.data,
+    # have to keep the frame itself as well.
+    def __init__(self, size):
+        self.size = size
+        self.shape = None
+        self.dtype = None
+        self.frames = []
+        # The count of a frame only the pool refers to, measured through the same call as
+        # in copy, since what getrefcount reports depends on the interpreter
+        self.free_refcount = FramePool.refcount([np.empty(0)], 0)
+
+    @staticmethod
+    def refcount(frames, index):
+        return sys.getrefcount(frames[index])
+
+    def reset(self, size, shape, dtype):
+        # Called when the stream's image type is known, every frame then has this layout
+        self.size = size
+        self.shape = shape
+        self.dtype = dtype
+        self.frames = []
+
+    def copy(self, image):
+        if self.shape is None:
+            raise RuntimeError("FramePool.copy called before reset, the frame layout is unknown")
+        for index in range(len(self.frames)):
+            if FramePool.refcount(self.frames, index) == self.free_refcount:
+                frame = self.frames[index]
+                np.copyto(frame, image)
+                return frame
+        frame = np.empty(self.shape, dtype=self.dtype)
+        np.copyto(frame, image)
+        if len(self.frames) < self.size:
+            self.frames.append(frame)
+        return frame
+
+
+def pixel_dtype(pixel_format: ic4.PixelFormat):
+    if pixel_format == ic4.PixelFormat.Mono8:
+        return np.uint8
+    return np.uint16
+
+
+# Sink buffers on top of the driver's minimum. Some are temporarily held by the
+# frame queue, the recorder and the display, on top of the ones being filled.
+EXTRA_BUFFERS = 4
+# Refresh the chunk data backed properties every this many frames
+CHUNKDATA_INTERVAL = 10
+
+STATISTICS_TEXT = 'Frames Delivered: %d Dropped: %d/%d/%d/%d'
+STATISTICS_TOOLTIP = (
+    'Frames Delivered: %d'
+    'Frames Dropped:'
+    '  Device Transmission Error: %d'
+    '  Device Underrun: %d'
+    '  Transform Underrun: %d'
+    '  Sink Underrun: %d'
+)
+
 
 class Camera(QObject):
     new_frame = Signal(np.ndarray)
@@ -15,23 +79,37 @@ class Camera(QObject):
     opened = Signal(int, int, int, int, int, int)
     label_update = Signal(str)
     statistics_update = Signal(str, str)
+    # The frames' shape or dtype differ from the previous stream
+    format_changed = Signal()
 
-    def __init__(self, parent):
+    def __init__(self, parent, extra_buffers: int = EXTRA_BUFFERS):
         super().__init__(parent)
+        self.extra_buffers = extra_buffers
         self.grabber = ic4.Grabber()
         self.grabber.event_add_device_lost(lambda g: QApplication.postEvent(self, QEvent(DEVICE_LOST_EVENT)))
         self.device_property_map = None
         self.property_dialog = None
+        self.frame_pool = FramePool(0)
+        self.frames_since_chunkdata = 0
+        self.last_statistics = None
 
         self.update_statistics_timer = QTimer()
         self.update_statistics_timer.timeout.connect(self.update_statistics)
-        self.update_statistics_timer.start()
+        self.update_statistics_timer.start(500)
         
         class Listener(ic4.QueueSinkListener):
-            def sink_connected(self, sink: ic4.QueueSink, image_type: ic4.ImageType, min_buffers_required: int) -> bool:
-                # Allocate more buffers than suggested, because we temporarily take some buffers
-                # out of circulation when saving an image or video files.
-                sink.alloc_and_queue_buffers(min_buffers_required + 2)
+            def sink_connected(listener, sink: ic4.QueueSink, image_type: ic4.ImageType, min_buffers_required: int) -> bool:
+                # Allocate more buffers than suggested, because frames are temporarily held on
+                # to downstream. The frame pool gets as many slots, so its copies are never the limit.
+                buffer_count = min_buffers_required + self.extra_buffers
+                sink.alloc_and_queue_buffers(buffer_count)
+                # Mono formats, wrapped by ic4 as (height, width, 1)
+                shape = (image_type.height, image_type.width, 1)
+                dtype = pixel_dtype(image_type.pixel_format)
+                changed = self.frame_pool.shape is not None and (self.frame_pool.shape, self.frame_pool.dtype) != (shape, dtype)
+                self.frame_pool.reset(buffer_count, shape, dtype)
+                if changed:
+                    self.format_changed.emit()
                 return True
 
             def sink_disconnected(self, sink: ic4.QueueSink):
@@ -39,11 +117,19 @@ class Camera(QObject):
 
             def frames_queued(listener, sink: ic4.QueueSink):
                 buf = sink.pop_output_buffer()
-                
-                self.new_frame.emit(buf.numpy_copy())
+
+                # numpy_wrap is a view of sink owned memory, only valid until the buffer is
+                # requeued. It must not leave this callback, receivers get a pooled copy.
+                wrap = buf.numpy_wrap()
+                frame = self.frame_pool.copy(wrap)
+                self.new_frame.emit(frame)
                 # Connect the buffer's chunk data to the device's property map
-                # This allows for properties backed by chunk data to be updated
-                self.device_property_map.connect_chunkdata(buf)
+                # This allows for properties backed by chunk data to be updated,
+                # they're only read by people and the metadata so not every frame
+                self.frames_since_chunkdata += 1
+                if self.frames_since_chunkdata >= CHUNKDATA_INTERVAL:
+                    self.frames_since_chunkdata = 0
+                    self.device_property_map.connect_chunkdata(buf)
                 #self.update_frame(buffer)
         self.sink = ic4.QueueSink(Listener())
 
@@ -110,16 +196,12 @@ class Camera(QObject):
             return
         try:
             stats = self.grabber.stream_statistics
-            text = f'Frames Delivered: {stats.sink_delivered} Dropped: {stats.device_transmission_error}/{stats.device_underrun}/{stats.transform_underrun}/{stats.sink_underrun}'
-            tooltip = (
-                f'Frames Delivered: {stats.sink_delivered}'
-                f'Frames Dropped:'
-                f'  Device Transmission Error: {stats.device_transmission_error}'
-                f'  Device Underrun: {stats.device_underrun}'
-                f'  Transform Underrun: {stats.transform_underrun}'
-                f'  Sink Underrun: {stats.sink_underrun}'
-            )
-            self.statistics_update.emit(text, tooltip)
+            counts = (stats.sink_delivered, stats.device_transmission_error, stats.device_underrun, stats.transform_underrun, stats.sink_underrun)
+            # Nothing to redraw while the stream is idle
+            if counts == self.last_statistics:
+                return
+            self.last_statistics = counts
+            self.statistics_update.emit(STATISTICS_TEXT % counts, STATISTICS_TOOLTIP % counts)
         except ic4.IC4Exception:
             pass
     
@@ -133,6 +215,8 @@ class Camera(QObject):
     
     def onDeviceOpened(self):
         self.device_property_map = self.grabber.device_property_map
+        # The statistics label was cleared with the previous device
+        self.last_statistics = None
 
         self.device_property_map.set_value(ic4.PropId.OFFSET_AUTO_CENTER, 'Off')
         self.device_property_map.set_value(ic4.PropId.GAIN_AUTO, 'Off')
@@ -152,6 +236,14 @@ class Camera(QObject):
         # if start_stream_on_open
         self.startStopStream()
     
+    # Layout of the streamed frames as set up in sink_connected, also after the format was
+    # changed in the property dialog
+    def frame_shape(self):
+        return self.frame_pool.shape
+    
+    def frame_dtype(self):
+        return self.frame_pool.dtype
+    
     def customEvent(self, ev: QEvent):
         if ev.type() == DEVICE_LOST_EVENT:
             self.onDeviceLost()
@@ -1,13 +1,20 @@
-from PySide6.QtCore import QStandardPaths, QDir, QTimer, QEvent, QFileInfo, Qt, Signal, QThread, QWaitCondition, QMutex, QTemporaryFile
+from PySide6.QtCore import QStandardPaths, QDir, QTimer, QEvent, QFileInfo, Qt, Signal, QThread, QMutex, QTemporaryFile, QMetaMethod, QObject
 from PySide6.QtGui import QAction, QKeySequence, QCloseEvent, QIcon, QImage
 from PySide6.QtWidgets import QMainWindow, QMessageBox, QLabel, QApplication, QFileDialog, QToolBar, QPushButton, QInputDialog
 
 import os
+import math
+import shutil
+import queue
 import numpy as np
 import tifffile as tiff
 import cv2
 import time
 import yaml
+try:
+    from yaml import CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeDumper as YamlDumper
 
 # Stage
 from pymmcore_plus import CMMCorePlus
@@ -20,23 +27,94 @@ from widgets import VideoView, SweepDialog
 import processing as pc
 from camera import Camera
 
-from functools import partial
+from functools import partial, cache
 
 
+APPLICATION_PATH = os.path.abspath(os.path.dirname(__file__)) + os.sep
 
+@cache
+def icon(name: str) -> QIcon:
+    # Loaded on first use, QIcon needs the QApplication so this can't happen at import time
+    return QIcon(APPLICATION_PATH + 'images/' + name)
 
-class PersistentWorkerThread(QThread):
-    def __init__(self, func):
-        super().__init__()
-        self.func = func
+
+# Number of grid sweep points reduced to background subtracted images at once while saving
+SWEEP_CHUNK = 8
+# Shortest time between two preview redraws in seconds, faster cameras are shown at about 30 fps
+DISPLAY_INTERVAL = 1/30
+
+
+class StageWorkerThread(QThread):
+    # Runs stage moves off the GUI thread, moves requested while the stage is busy are merged
+    failed = Signal(str)
+    def __init__(self, parent, move):
+        super().__init__(parent)
+        self.move = move
+        self.commands = queue.Queue(maxsize=64)
+    
+    def put(self, displacement: np.ndarray):
+        try:
+            self.commands.put_nowait(displacement)
+        except queue.Full:
+            pass
+    
+    def stop(self):
+        self.commands.put(None)
+        self.wait()
+    
+    def run(self):
+        while True:
+            displacement = self.commands.get()
+            if displacement is None:
+                return
+            while not self.commands.empty():
+                pending = self.commands.get_nowait()
+                if pending is None:
+                    return
+                displacement = displacement + pending
+            try:
+                self.move(displacement)
+            except RuntimeError as e:
+                self.failed.emit(f'Stage move failed: \n{e}')
+
+
+class NpyWriterThread(QThread):
+    failed = Signal(str)
+    def __init__(self, parent, path: str, array: np.ndarray):
+        super().__init__(parent)
+        self.path = path
+        self.array = array
+    
+    def run(self):
+        # Write through a memory map so the OS can flush it lazily
+        try:
+            mm = np.lib.format.open_memmap(self.path, mode='w+', dtype=self.array.dtype, shape=self.array.shape)
+            mm[:] = self.array
+            mm.flush()
+            del mm
+        except OSError as e:
+            # E.g. a full disk, reported on the GUI thread
+            self.failed.emit(f'Saving {self.path} failed: \n{e}')
+
+
+class WarmUpThread(QThread):
+    # Compiles the processing kernels off the GUI thread, without a JIT cache that takes seconds
+    failed = Signal(str)
+    
+    def run(self):
+        try:
+            pc.warm_up()
+        except Exception as e:
+            self.failed.emit(f'Compiling the image processing failed: \n{e}')
 
 
 class MainWindow(QMainWindow):
     new_processed_frame = Signal(np.ndarray)
+    aquisition_message = Signal(str)
+    error_message = Signal(str)
     def __init__(self):
-        application_path = os.path.abspath(os.path.dirname(__file__)) + os.sep
         QMainWindow.__init__(self)
-        self.setWindowIcon(QIcon(application_path + '/images/tis.ico'))
+        self.setWindowIcon(icon('tis.ico'))
 
         # Setup stage
         # Setup microscope connection
@@ -48,13 +126,18 @@ class MainWindow(QMainWindow):
         self.laser.changedState.connect(self.update_controls)
         
         self.grid = False
-        self.got_image_mutex = QMutex()
-        self.got_image = QWaitCondition()
+        # Frames requested by the aquisition workers, filled from the camera thread
+        self.frame_queue = queue.Queue(maxsize=8)
+        self.collecting = False
+        self.frames_to_discard = 0
 
         self.aquiring = False
         self.aquiring_mutex = QMutex()
 
         self.temp_video_file = None
+        # Raw data writers still running, waited for on close
+        self.npy_writers = set()
+        self.save_worker = None
         
 
         # Make sure the %appdata%/demoapp directory exists
@@ -73,18 +156,42 @@ class MainWindow(QMainWindow):
 
         self.video_view = VideoView(self)
         self.video_view.roi_set.connect(self.update_roi)
-        self.move_stage_worker = PersistentWorkerThread(self.move_stage)
-        self.video_view.move_stage.connect(self.move_stage_worker.func)
+        self.stage_worker = StageWorkerThread(self, self.move_stage)
+        self.stage_worker.failed.connect(self.stage_failed)
+        self.stage_error_shown = False
+        self.video_view.move_stage.connect(self.stage_worker.put)
+        self.stage_worker.start()
 
         self.camera = Camera(self)
         self.camera.new_frame.connect(self.update_display)
+        self.camera.new_frame.connect(self.collect_frame, Qt.ConnectionType.DirectConnection)
         self.camera.state_changed.connect(self.update_controls)
         self.camera.opened.connect(self.video_view.set_size)
         self.camera.opened.connect(self.init_roi)
+        self.camera.format_changed.connect(self.frame_format_changed)
         
 
+        self._subtract_background = False
         self.background: np.ndarray = None
-        self.subtract_background = False
+        # Reused output of the live background subtraction
+        self.display_buffer: np.ndarray = None
+        self.device_metadata: dict = None
+        self.new_processed_frame_method = QMetaMethod.fromSignal(self.new_processed_frame)
+        # A kernel still compiling when first used is waited for by Numba
+        self.warm_up_thread = WarmUpThread(self)
+        self.warm_up_thread.failed.connect(self.error_message)
+        try:
+            pc.launch_threads()
+        except Exception as e:
+            QMessageBox.warning(self, 'Error', f'failed to start the image processing threads: \n{e}')
+        else:
+            self.warm_up_thread.start()
+        # Newest frame waiting to be drawn, as (frame, processed)
+        self.latest_frame: tuple = None
+        self.last_draw = 0
+        self.display_timer = QTimer(self)
+        self.display_timer.setSingleShot(True)
+        self.display_timer.timeout.connect(self.show_latest_frame)
 
         self.createUI()
         self.update_controls()
@@ -92,14 +199,13 @@ class MainWindow(QMainWindow):
     
 
     def setup_micromanager(self, mm_dir):
-        application_path = os.path.abspath(os.path.dirname(__file__)) + os.sep
         self.xy_stage = None
         self.z_stage = None
         
         self.mmc = CMMCorePlus.instance()
         try:
             self.mmc.setDeviceAdapterSearchPaths([mm_dir])
-            self.mmc.loadSystemConfiguration(os.path.join(application_path, 'MMConfig.cfg'))
+            self.mmc.loadSystemConfiguration(APPLICATION_PATH + 'MMConfig.cfg')
         except Exception as e:
             QMessageBox.warning(self, 'Error', f'failed to load mm config: \n{e}')
         else:
@@ -112,14 +218,13 @@ class MainWindow(QMainWindow):
         #=========#
         # Actions #
         #=========#
-        application_path = os.path.abspath(os.path.dirname(__file__)) + os.sep
         
-        self.device_select_act = QAction(QIcon(application_path + 'images/camera.png'), '&Select', self)
+        self.device_select_act = QAction(icon('camera.png'), '&Select', self)
         self.device_select_act.setStatusTip('Select a video capture device')
         self.device_select_act.setShortcut(QKeySequence.Open)
         self.device_select_act.triggered.connect(partial(self.camera.onSelectDevice, self))
 
-        self.device_properties_act = QAction(QIcon(application_path + 'images/imgset.png'), '&Properties', self)
+        self.device_properties_act = QAction(icon('imgset.png'), '&Properties', self)
         self.device_properties_act.setStatusTip('Show device property dialog')
         self.device_properties_act.triggered.connect(partial(self.camera.onDeviceProperties, self))
 
@@ -127,7 +232,7 @@ class MainWindow(QMainWindow):
         self.device_driver_properties_act.setStatusTip('Show device driver property dialog')
         self.device_driver_properties_act.triggered.connect(partial(self.camera.onDeviceDriverProperties, self))
 
-        self.start_live_act = QAction(QIcon(application_path + 'images/livestream.png'), '&Live Stream', self)
+        self.start_live_act = QAction(icon('livestream.png'), '&Live Stream', self)
         self.start_live_act.setStatusTip('Start and stop the live stream')
         self.start_live_act.setCheckable(True)
         self.start_live_act.triggered.connect(self.camera.startStopStream)
@@ -171,7 +276,7 @@ class MainWindow(QMainWindow):
         self.z_sweep_act.setStatusTip('Perform a focus sweep')
         self.z_sweep_act.triggered.connect(self.z_sweep)
 
-        self.video_act = QAction(QIcon(application_path + "images/recordstart.png"), "&Capture Video", self)
+        self.video_act = QAction(icon('recordstart.png'), "&Capture Video", self)
         self.video_act.setToolTip("Capture Video")
         self.video_act.setCheckable(True)
         self.video_act.toggled.connect(self.toggle_video)
@@ -258,6 +363,8 @@ class MainWindow(QMainWindow):
         self.statusBar().showMessage('Ready')
         self.aquisition_label = QLabel('', self.statusBar())
         self.statusBar().addPermanentWidget(self.aquisition_label)
+        self.aquisition_message.connect(self.aquisition_label.setText)
+        self.error_message.connect(self.show_error)
         self.statistics_label = QLabel('', self.statusBar())
         self.camera.statistics_update.connect(lambda s1, s2: (self.statistics_label.setText(s1), self.statistics_label.setToolTip(s2)))
         self.statusBar().addPermanentWidget(self.statistics_label)
@@ -290,24 +397,37 @@ class MainWindow(QMainWindow):
         self.snap_processed_photo_act.setEnabled(grabber.is_streaming and not self.aquiring and xy_okay)
         self.snap_raw_photo_act.setEnabled(grabber.is_streaming and not self.aquiring)
         self.z_sweep_act.setEnabled(grabber.is_streaming and not self.aquiring and z_stage_connected and xy_okay and self.laser.open)
-        self.set_roi_act.setEnabled(grabber.is_device_valid and not self.video_view.background.rect().isEmpty() and not self.aquiring)
+        # The recording's frame type and conversion are fixed when it starts
+        recording = self.video_act.isChecked()
+        self.set_roi_act.setEnabled(grabber.is_device_valid and not self.video_view.background.rect().isEmpty() and not self.aquiring and not recording)
         self.move_act.setEnabled(grabber.is_streaming and not self.aquiring and xy_okay)
         self.move_act.setChecked(self.video_view.mode == 'move')
         self.set_roi_act.setChecked(self.video_view.mode == 'roi')
-        self.subtract_background_act.setEnabled(self.background is not None)
+        self.subtract_background_act.setEnabled(self.background is not None and not recording)
         self.laser_sweep_act.setEnabled(self.laser.open and not self.aquiring and grabber.is_streaming)
         self.grab_release_laser_act.setChecked(self.laser.open)
 
     def closeEvent(self, ev: QCloseEvent):
+        self.stage_worker.stop()
+        self.warm_up_thread.wait()
+        # Destroying a running thread aborts the process and truncates the file
+        if self.save_worker is not None:
+            self.save_worker.wait()
+        for writer in list(self.npy_writers):
+            writer.wait()
         self.camera.closeEvent(ev)
     
+    def show_error(self, message: str):
+        QMessageBox.warning(self, 'Error', message)
+    
     #==============================================#
     # Functions to take raw images and aquisitions #
     #==============================================#
     
     # Snap and save one raw image
     def snap_photo(self):
-        self.camera.new_frame.connect(self.save_image, Qt.ConnectionType.SingleShotConnection)
+        # Copied so the pooled camera frame isn't held while the save dialog is open
+        self.camera.new_frame.connect(lambda frame: self.save_image(frame.copy()), Qt.ConnectionType.SingleShotConnection)
     
 
     def save_image(self, image: np.ndarray):
@@ -318,9 +438,8 @@ class MainWindow(QMainWindow):
         dialog.setDirectory(self.data_directory)
 
         if dialog.exec():
-            filepath = dialog.selectedFiles()[0]
-            filepath = os.path.splitext(filepath)[0]
-            tiff.imwrite(filepath + '.tif', image)
+            base = os.path.splitext(dialog.selectedFiles()[0])[0]
+            tiff.imwrite(base + '.tif', image)
         self.data_directory = dialog.directory()
 
 
@@ -339,88 +458,207 @@ class MainWindow(QMainWindow):
             parent.aquiring = True
             parent.aquiring_mutex.unlock()
             parent.update_controls()
+            # finished is delivered on the GUI thread, the controls must not be touched from run
+            self.finished.connect(parent.update_controls)
 
         def run(self):
-            self.func(*self.args)
+            try:
+                self.func(*self.args)
+            except OSError as e:
+                # E.g. a full disk while saving, done is not emitted so nothing follows on the partial result
+                self.parent.aquisition_message.emit('')
+                self.parent.error_message.emit(f'Stopped: \n{e}')
+                return
+            finally:
+                # Release the aquisition before notifying, so a follow-up worker started from done keeps its state
+                self.finish_aquisition()
             self.done.emit()
-            self.finish_aquisition()
         
         def finish_aquisition(self):
             self.parent.aquiring_mutex.lock()
             self.parent.aquiring = False
             self.parent.aquiring_mutex.unlock()
-            self.parent.update_controls()
 
-    def take_sequence(self):
+    def take_sequence(self, settle: float = 0.2):
+        # settle applies to the first position, so a change made just before the sequence can settle as well
         distance = 4
         positions = np.array([[0,0], [1,0], [1,1], [0,1]])*distance
         anchor = np.array(self.mmc.getXYPosition(self.xy_stage))
-        for i, position in enumerate(positions):
-            pos = position + anchor
-            self.mmc.setXYPosition(pos[0], pos[1])
+        targets = [position + anchor for position in positions]
+        self.mmc.setXYPosition(targets[0][0], targets[0][1])
+        try:
+            for i in range(len(positions)):
+                self.mmc.waitForDevice(self.xy_stage)
+                # shoot photo and wait for it to be shot
+                image = self.grab_frame(settle=settle if i == 0 else 0.2)
+                # The frame is in, start the next move before storing it
+                if i + 1 < len(targets):
+                    pos = targets[i+1]
+                    self.mmc.setXYPosition(pos[0], pos[1])
+                self.photos.append(image)
+        finally:
+            # Return to base, also when no frame arrived.
+            # setXYPosition doesn't block, the next sequence reads its anchor from the stage
+            self.mmc.setXYPosition(anchor[0], anchor[1])
             self.mmc.waitForDevice(self.xy_stage)
-            time.sleep(0.2)
-            # shoot photo and wait for it to be shot
-            self.camera.new_frame.connect(self.store_sequence_image, Qt.ConnectionType.SingleShotConnection)
-            self.got_image_mutex.lock()
-            self.got_image.wait(self.got_image_mutex)
-            self.got_image_mutex.unlock()
-        
-        # Return to base
-        self.mmc.setXYPosition(anchor[0], anchor[1])
 
-    def store_sequence_image(self, image: np.ndarray):
-        self.photos.append(image)
-        self.got_image.wakeAll()
+    def collect_frame(self, image: np.ndarray):
+        # Runs on the camera thread
+        if self.collecting:
+            if self.frames_to_discard > 0:
+                self.frames_to_discard -= 1
+                return
+            try:
+                self.frame_queue.put_nowait(image)
+            except queue.Full:
+                pass
+    
+    def grab_frame(self, settle: float = 0, timeout: float = 10) -> np.ndarray:
+        # Wait for the next frame from the camera, called from the aquisition workers.
+        # Instead of sleeping for settle seconds, the frames exposed during that time are skipped.
+        # No lock is shared with the camera thread, it only reads collecting and then touches the queue.
+        fps = self.camera.device_property_map.get_value_float(ic4.PropId.ACQUISITION_FRAME_RATE)
+        # A frame the camera thread was still putting when the previous grab ended may be left over
+        self.drain_frame_queue()
+        self.frames_to_discard = math.ceil(fps*settle)
+        self.collecting = True
+        try:
+            image = self.frame_queue.get(timeout=timeout + settle)
+        except queue.Empty:
+            # An OSError, so the aquisition worker reports it
+            raise TimeoutError(f'No frame from the camera within {timeout + settle:g} s') from None
+        finally:
+            self.collecting = False
+            # Drop frames that arrived in the meantime, they are not needed anymore
+            self.drain_frame_queue()
+        return image
+
+    def drain_frame_queue(self):
+        try:
+            while True:
+                self.frame_queue.get_nowait()
+        except queue.Empty:
+            pass
     
     def toggle_video(self, start: bool):
         if start:
             self.start_video()
         else:
             self.stop_video()
+        self.update_controls()
 
     def start_video(self):
-        self.photos = []
-        self.new_processed_frame.connect(self.write_frame)
+        # Frames are streamed to a temporary TIFF while recording, so memory use stays constant.
+        # Saving moves it into place or converts it.
+        self.temp_video_file = QTemporaryFile(QDir.tempPath() + '/monitor_XXXXXX.tif')
+        self.temp_video_file.open()
+        self.temp_video_file.close()
+        self.video_writer = tiff.TiffWriter(self.temp_video_file.fileName(), bigtiff=True)
+        self.video_frame_count = 0
+        self.video_fps = int(self.camera.device_property_map.get_value_float(ic4.PropId.ACQUISITION_FRAME_RATE))
+        # Image writer only support uint8, the conversion is fixed for the whole recording
+        dtype = np.uint16 if self.subtract_background else self.camera.frame_dtype()
+        if dtype == np.uint16:
+            # Shifted straight into one reused uint8 frame, no uint16 temporary per frame
+            converted = None
+            def convert(frame):
+                nonlocal converted
+                if converted is None or converted.shape != frame.shape:
+                    converted = np.empty(frame.shape, dtype=np.uint8)
+                return pc.mono16_to_mono8(frame, converted)
+            self.video_convert = convert
+        else:
+            self.video_convert = lambda frame: frame
+        self.video_connection = self.new_processed_frame.connect(self.write_frame)
 
     def write_frame(self, frame: np.ndarray):
-        self.photos.append(frame)
+        try:
+            self.video_writer.write(frame, photometric='minisblack', contiguous=True)
+        except OSError as e:
+            # E.g. a full disk, stop and offer what was recorded so far instead of failing every frame.
+            # Frames arriving while the warning is open are not written, and the reason is shown
+            # before stop_video asks where to save.
+            QObject.disconnect(self.video_connection)
+            QMessageBox.warning(self, 'Error', f'Recording stopped: \n{e}')
+            self.video_act.setChecked(False)
+            return
+        self.video_frame_count += 1
     
     def stop_video(self):
-        self.new_processed_frame.disconnect(self.write_frame)
+        # Already disconnected if writing failed
+        QObject.disconnect(self.video_connection)
+        try:
+            self.video_writer.close()
+        except OSError as e:
+            # Likely the same full disk that stopped the recording, the pages written so far are still offered
+            QMessageBox.warning(self, 'Error', f'Finishing the recording failed: \n{e}')
 
         dialog = QFileDialog(self, 'Save Video')
         dialog.setNameFilters(('Multi Page TIF (*.tif)', 'AVI Video (*.avi)'))
         dialog.setFileMode(QFileDialog.FileMode.AnyFile)
         dialog.setAcceptMode(QFileDialog.AcceptMode.AcceptSave)
         dialog.setDirectory(self.save_videos_directory)
-        if dialog.exec():
+        if dialog.exec() and self.video_frame_count > 0:
 
-            filepath = dialog.selectedFiles()[0]
-            filepath = os.path.splitext(filepath)[0]
+            base = os.path.splitext(dialog.selectedFiles()[0])[0]
             nameFilter = dialog.selectedNameFilter()
             if '.tif' in nameFilter:
-                photos = np.array(self.photos)
-                if photos.dtype == np.uint16:
-                    photos = (photos/256).astype(np.uint8)
-                
-                tiff.imwrite(filepath + '.tif', np.array(self.photos))
-
+                self.save_worker = self.AquisitionWorkerThread(self, shutil.move, self.temp_video_file.fileName(), base + '.tif')
             elif '.avi' in nameFilter:
-                fps = int(self.camera.device_property_map.get_value_float(ic4.PropId.ACQUISITION_FRAME_RATE))
-                self.writer = cv2.VideoWriter(filepath + '.avi', cv2.VideoWriter_fourcc(*'XVID'), fps, (self.roi_width, self.roi_height), False)
-
-                for photo in self.photos:
-                    # Image writer only support uint8
-                    if photo.dtype == np.uint16:
-                        self.writer.write((photo/256).astype(np.uint8))
-                    elif (photo.dtype ==np.uint8):
-                        self.writer.write(photo)
-
-                
-                self.writer.release()
+                self.save_worker = self.AquisitionWorkerThread(self, self.convert_video, self.temp_video_file.fileName(), base + '.avi')
+            self.aquisition_label.setText('Saving Video')
+            self.save_worker.done.connect(self.finish_video)
+            self.save_worker.start()
+        else:
+            self.temp_video_file = None
         self.save_videos_directory = dialog.directory()
 
+    def convert_video(self, source: str, path: str):
+        frames = tiff.memmap(source, mode='r')
+        # A single page would otherwise be iterated row by row
+        frames = frames.reshape((self.video_frame_count,) + frames.shape[-3:])
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'XVID'), self.video_fps, (frames.shape[2], frames.shape[1]), False)
+        for frame in frames:
+            writer.write(self.video_convert(frame))
+        writer.release()
+        del frames
+    
+    def finish_video(self):
+        # Removes the temporary file if it was not moved
+        self.temp_video_file = None
+        self.finish_saving()
+    
+    def save_npy(self, path: str, array):
+        # Returns immediately, the raw data is written in the background
+        writer = NpyWriterThread(self, path, np.asarray(array))
+        writer.failed.connect(self.error_message)
+        writer.finished.connect(lambda: self.npy_writers.discard(writer))
+        writer.finished.connect(writer.deleteLater)
+        self.npy_writers.add(writer)
+        writer.start()
+    
+    def write_sweep(self, base: str, raw: np.ndarray, metadata: dict):
+        with open(base + '.yaml', 'w') as file:
+            yaml.dump(metadata, file, Dumper=YamlDumper)
+        
+        # Fill a memory mapped TIFF, grid sweeps are reduced to background subtracted
+        # images a chunk at a time so the processed stack is never held in memory
+        grid = raw.ndim == 5
+        shape = raw.shape[:1] + raw.shape[-3:]
+        images = tiff.memmap(base + '.tif', shape=shape, dtype=np.uint16 if grid else raw.dtype, bigtiff=True, photometric='minisblack')
+        for start in range(0, len(raw), SWEEP_CHUNK):
+            part = raw[start:start + SWEEP_CHUNK]
+            if grid:
+                images[start:start + SWEEP_CHUNK] = pc.background_subtracted_to_mono(part[:, 0], pc.common_background(part, axis=1))
+            else:
+                images[start:start + SWEEP_CHUNK] = part
+        images.flush()
+        del images
+    
+    def finish_saving(self):
+        self.aquisition_label.setText('')
+        self.statusBar().showMessage('Done!')
+
 
 
     # Snap a sequence of images in a grid to calculate the background and save it.
@@ -430,17 +668,64 @@ class MainWindow(QMainWindow):
         if self.grid:
             self.photos = []
             if not self.aquiring:
-                self.aquisition_worker = self.AquisitionWorkerThread(self, self.take_sequence)
-                self.aquisition_worker.done.connect(self.set_background)
+                self.aquisition_worker = self.AquisitionWorkerThread(self, self.take_background_sequence)
                 self.aquisition_worker.start()
         else:
             self.camera.new_frame.connect(self.set_background, Qt.ConnectionType.SingleShotConnection)
+
+    def take_background_sequence(self):
+        self.take_sequence()
+        # Combine the backgrounds on the worker as well, so the GUI stays responsive
+        self.try_set_background(pc.common_background(self.photos))
     
-    def set_background(self, image: np.ndarray=None):
-        if image is not None:
-            self.background = image
-        else:
-            self.background = pc.common_background(self.photos)
+    @property
+    def background(self) -> np.ndarray:
+        return self._background
+
+    @background.setter
+    def background(self, background: np.ndarray):
+        # Every background, snapped or combined, is kept packed in the frames' (H, W, 1) layout
+        if background is not None:
+            background = np.ascontiguousarray(background)
+            # Fail here rather than on every live frame
+            shape = self.camera.frame_shape()
+            if background.shape != shape or background.dtype != self.camera.frame_dtype():
+                raise ValueError(f"Background {background.shape} {background.dtype} doesn't match the frames {shape} {np.dtype(self.camera.frame_dtype())}")
+        self._background = background
+        # Derived once per background for the live subtraction
+        self.background_reciprocal = None if background is None else pc.background_reciprocal(background)
+        self.select_frame_processor()
+
+    @property
+    def subtract_background(self) -> bool:
+        return self._subtract_background
+
+    @subtract_background.setter
+    def subtract_background(self, subtract_background: bool):
+        self._subtract_background = subtract_background
+        self.select_frame_processor()
+
+    def set_background(self, image: np.ndarray):
+        # Keep a copy, the live frame goes back to the camera's pool
+        self.try_set_background(image.copy())
+        self.update_controls()
+    
+    def try_set_background(self, background: np.ndarray) -> bool:
+        # Also called from the aquisition workers, the error is shown on the GUI thread
+        try:
+            self.background = background
+        except ValueError as e:
+            self.error_message.emit(f'Background not set: \n{e}')
+            return False
+        return True
+    
+    def frame_format_changed(self):
+        # The camera's pixel format or frame size changed, e.g. in the property dialog
+        self.roi_height, self.roi_width, _ = self.camera.frame_shape()
+        self.roi_offset_x = self.camera.device_property_map.get_value_int(ic4.PropId.OFFSET_X)
+        self.roi_offset_y = self.camera.device_property_map.get_value_int(ic4.PropId.OFFSET_Y)
+        self.subtract_background = False
+        self.background = None
         self.update_controls()
     
     # Background subtracted photos
@@ -453,8 +738,8 @@ class MainWindow(QMainWindow):
                 self.aquisition_worker.done.connect(self.save_processed_photo)
                 self.aquisition_worker.start()
         else:
-            # Snap single picture
-            self.new_processed_frame.connect(self.save_image, Qt.ConnectionType.SingleShotConnection)
+            # Snap single picture, copied because the processed frame buffer is reused
+            self.new_processed_frame.connect(lambda frame: self.save_image(frame.copy()), Qt.ConnectionType.SingleShotConnection)
 
     def save_processed_photo(self):
         dialog = QFileDialog(self, 'Save Photo')
@@ -463,20 +748,24 @@ class MainWindow(QMainWindow):
         dialog.setAcceptMode(QFileDialog.AcceptMode.AcceptSave)
         dialog.setDirectory(self.data_directory)
         if dialog.exec():
-            filepath = dialog.selectedFiles()[0]
-            filepath = os.path.splitext(filepath)[0]
+            base = os.path.splitext(dialog.selectedFiles()[0])[0]
             
-            background = pc.common_background(self.photos)
-            data = self.photos[0]
-
-            diff = pc.background_subtracted(data, background)
+            # Stacked once, in the frames' own dtype, for both the processing and the raw data
+            photos = np.stack(self.photos)
+            background = pc.common_background(photos)
 
-            
             # also contains raw data
-            tiff.imwrite(filepath + '.tif', pc.float_to_mono(diff))
-            np.save(os.path.splitext(filepath)[0] + '_raw.npy', self.photos)
+            tiff.imwrite(base + '.tif', pc.background_subtracted_to_mono(photos[0], background))
+            self.save_npy(base + '_raw.npy', photos)
         self.data_directory = dialog.directory()
 
+    def allocate_sweep(self, length: int) -> np.ndarray:
+        # Grid mode keeps the four sequence images of every sweep point
+        shape = self.camera.frame_shape()
+        if self.grid:
+            shape = (4,) + shape
+        return np.empty((length,) + shape, dtype=self.camera.frame_dtype())
+
     # Make a laser sweep
 
     def laser_sweep(self):
@@ -491,30 +780,27 @@ class MainWindow(QMainWindow):
             
 
     def take_laser_sweep(self):
+        self.cache_device_metadata()
         N = len(self.wavelens)
         self.laser.set_wavelen(self.wavelens[0])
         time.sleep(5)
-        self.laser_data_raw = []
+        self.laser_data_raw = self.allocate_sweep(N)
+        background = np.empty(self.laser_data_raw.shape[-3:], dtype=self.laser_data_raw.dtype)
+        # The live background only follows the sweep, a mismatch is reported once and doesn't stop it
+        show_background = True
         for i, wavelen in enumerate(self.wavelens):
-            self.aquisition_label.setText(f'Aquiring Data: laser sweep progression {i+1}/{N}')
+            self.aquisition_message.emit(f'Aquiring Data: laser sweep progression {i+1}/{N}')
             self.laser.set_wavelen(wavelen)
-            time.sleep(0.5)
             if self.grid:
                 self.photos = []
-                self.take_sequence()
-                self.laser_data_raw.append(self.photos)
-                self.background = pc.common_background(self.photos)
+                self.take_sequence(settle=0.5)
+                self.laser_data_raw[i] = self.photos
+                if show_background:
+                    show_background = self.try_set_background(pc.common_background(self.laser_data_raw[i], out=background))
             else:
-                self.camera.new_frame.connect(self.store_laser_data, Qt.ConnectionType.SingleShotConnection)
-                self.got_image_mutex.lock()
-                self.got_image.wait(self.got_image_mutex)
-                self.got_image_mutex.unlock()
+                self.laser_data_raw[i] = self.grab_frame(settle=0.5)
         
-        self.aquisition_label.setText('Calculating Images')
-    
-    def store_laser_data(self, image: np.ndarray):
-        self.laser_data_raw.append(image)
-        self.got_image.wakeAll()
+        self.aquisition_message.emit('Calculating Images')
     
     def save_laser_data(self):
         dialog = QFileDialog(self, 'Save Wavelength Sweep')
@@ -523,28 +809,25 @@ class MainWindow(QMainWindow):
         dialog.setAcceptMode(QFileDialog.AcceptMode.AcceptSave)
         dialog.setDirectory(self.data_directory)
         if dialog.exec():
-            filepath = dialog.selectedFiles()[0]
-            filepath = os.path.splitext(filepath)[0]
+            base = os.path.splitext(dialog.selectedFiles()[0])[0]
             
-            images = np.array(self.laser_data_raw)
-
-            if np.shape(images)[1] == 4:
-                np.save(filepath + '_raw.npy', images)
-                diff = np.array([pc.background_subtracted(photos[0], pc.common_background(photos)) for photos in images])
-                images = pc.float_to_mono(diff)
-
-            tiff.imwrite(filepath + '.tif', images)
+            raw = self.laser_data_raw
+            if raw.ndim == 5:
+                self.save_npy(base + '_raw.npy', raw)
 
             metadata = self.generate_metadata()
             metadata['Laser.wavelength [nm]'] = {
                 "Start": int(self.wavelens[0]),
                 "Stop": int(self.wavelens[-1]),
                 "Number": len(self.wavelens)}
-            with open(filepath+'.yaml', 'w') as file:
-                yaml.dump(metadata, file)
+
+            self.aquisition_label.setText('Saving Images')
+            self.save_worker = self.AquisitionWorkerThread(self, self.write_sweep, base, raw, metadata)
+            self.save_worker.done.connect(self.finish_saving)
+            self.save_worker.start()
+        else:
+            self.finish_saving()
         self.data_directory = dialog.directory()
-        self.aquisition_label.setText('')
-        self.statusBar().showMessage('Done!')
 
     # Make a Z sweep
 
@@ -557,37 +840,36 @@ class MainWindow(QMainWindow):
             self.aquisition_worker.start()
     
     def take_z_sweep(self):
+        self.cache_device_metadata()
         z_zero = self.mmc.getZPosition()
         N = len(self.z_positions)
         
-        self.z_data_raw = []
-        for i, z in enumerate(self.z_positions):
-            self.aquisition_label.setText(f'Aquiring Data: z sweep progression {i+1}/{N}')
-
-            # Set position
-            pos = z_zero + z
-            self.z_position = i
-            self.mmc.setZPosition(pos)
-            self.mmc.waitForDevice(self.z_stage)
-            time.sleep(0.1)
-            # Take picture
-            if self.grid:
-                self.photos = []
-                self.take_sequence()
-                self.z_data_raw.append(self.photos)
-                self.background = pc.common_background(self.photos)
-            else:
-                self.camera.new_frame.connect(self.store_z_data, Qt.ConnectionType.SingleShotConnection)
-                self.got_image_mutex.lock()
-                self.got_image.wait(self.got_image_mutex)
-                self.got_image_mutex.unlock()
-
-        self.mmc.setZPosition(z_zero)
-        self.aquisition_label.setText('Calculating Images')
-        
-    def store_z_data(self, image: np.ndarray):
-        self.z_data_raw.append(image)
-        self.got_image.wakeAll()
+        self.z_data_raw = self.allocate_sweep(N)
+        background = np.empty(self.z_data_raw.shape[-3:], dtype=self.z_data_raw.dtype)
+        # The live background only follows the sweep, a mismatch is reported once and doesn't stop it
+        show_background = True
+        try:
+            for i, z in enumerate(self.z_positions):
+                self.aquisition_message.emit(f'Aquiring Data: z sweep progression {i+1}/{N}')
+
+                # Set position
+                pos = z_zero + z
+                self.z_position = i
+                self.mmc.setZPosition(pos)
+                self.mmc.waitForDevice(self.z_stage)
+                # Take picture
+                if self.grid:
+                    self.photos = []
+                    self.take_sequence()
+                    self.z_data_raw[i] = self.photos
+                    if show_background:
+                        show_background = self.try_set_background(pc.common_background(self.z_data_raw[i], out=background))
+                else:
+                    self.z_data_raw[i] = self.grab_frame(settle=0.1)
+        finally:
+            # Back in focus, also when no frame arrived
+            self.mmc.setZPosition(z_zero)
+        self.aquisition_message.emit('Calculating Images')
     
 
     def save_z_data(self):
@@ -597,45 +879,76 @@ class MainWindow(QMainWindow):
         dialog.setAcceptMode(QFileDialog.AcceptMode.AcceptSave)
         dialog.setDirectory(self.data_directory)
         if dialog.exec():
-            filepath = dialog.selectedFiles()[0]
-            filepath = os.path.splitext(filepath)[0]
+            base = os.path.splitext(dialog.selectedFiles()[0])[0]
             
-            images = np.array(self.z_data_raw)
-
-            if np.shape(images)[1] == 4:
-                np.save(filepath + '_raw.npy', images)
-                diff = np.array([pc.background_subtracted(photos[0], pc.common_background(photos)) for photos in images])
-                images = pc.float_to_mono(diff)
-
-            tiff.imwrite(filepath + '.tif', images)
+            raw = self.z_data_raw
+            if raw.ndim == 5:
+                self.save_npy(base + '_raw.npy', raw)
 
             metadata = self.generate_metadata()
             metadata['Setup.z_focus [um]'] = {
                 "Start": int(self.z_positions[0]),
                 "Stop": int(self.z_positions[-1]),
                 "Number": len(self.z_positions)}
-            
-            with open(filepath +'.yaml', 'w') as file:
-                yaml.dump(metadata, file)
+
+            self.aquisition_label.setText('Saving Images')
+            self.save_worker = self.AquisitionWorkerThread(self, self.write_sweep, base, raw, metadata)
+            self.save_worker.done.connect(self.finish_saving)
+            self.save_worker.start()
+        else:
+            self.finish_saving()
         self.data_directory = dialog.directory()
-        self.aquisition_label.setText('')
-        self.statusBar().showMessage('Done!')
 
     
     def init_roi(self, width, height, max_width, max_height, offset_x, offset_y):
         self.roi_width = width
         self.roi_height = height
+        self.roi_offset_x = offset_x
+        self.roi_offset_y = offset_y
     
     def update_roi(self, roi):
+        width, height = int(roi.width()), int(roi.height())
+        offset_x, offset_y = int(roi.left()), int(roi.top())
+        if (width, height, offset_x, offset_y) == (self.roi_width, self.roi_height, self.roi_offset_x, self.roi_offset_y):
+            # Nothing changes, keep the stream and the background
+            self.update_controls()
+            return
+        
         # Set ROI in camera
-        self.camera.startStopStream()
-        self.camera.device_property_map.set_value(ic4.PropId.WIDTH, int(roi.width()))
-        self.camera.device_property_map.set_value(ic4.PropId.HEIGHT, int(roi.height()))
-        self.camera.device_property_map.set_value(ic4.PropId.OFFSET_X, int(roi.left()))
-        self.camera.device_property_map.set_value(ic4.PropId.OFFSET_Y, int(roi.top()))
-        self.camera.startStopStream()
-        self.roi_width = roi.width()
-        self.roi_height = roi.height()
+        property_map = self.camera.device_property_map
+        restarted = False
+        if (width, height) == (self.roi_width, self.roi_height) and self.camera.grabber.is_streaming:
+            # Only the offsets change, which the camera usually accepts while streaming
+            try:
+                property_map.set_value(ic4.PropId.OFFSET_X, offset_x)
+                property_map.set_value(ic4.PropId.OFFSET_Y, offset_y)
+            except ic4.IC4Exception:
+                restarted = True
+        else:
+            restarted = True
+        
+        if restarted:
+            streaming = self.camera.grabber.is_streaming
+            if streaming:
+                self.camera.startStopStream()
+            # Shrink before moving and move before growing so offset + size never leaves the sensor
+            for size_id, offset_id, size, offset, current_size in (
+                    (ic4.PropId.WIDTH, ic4.PropId.OFFSET_X, width, offset_x, self.roi_width),
+                    (ic4.PropId.HEIGHT, ic4.PropId.OFFSET_Y, height, offset_y, self.roi_height)):
+                if size < current_size:
+                    property_map.set_value(size_id, size)
+                    property_map.set_value(offset_id, offset)
+                else:
+                    property_map.set_value(offset_id, offset)
+                    property_map.set_value(size_id, size)
+            if streaming:
+                self.camera.startStopStream()
+        
+        self.roi_width = width
+        self.roi_height = height
+        self.roi_offset_x = offset_x
+        self.roi_offset_y = offset_y
+        # The background was taken of a different part of the sensor
         self.subtract_background = False
         self.background = None
 
@@ -645,6 +958,14 @@ class MainWindow(QMainWindow):
     def move_stage(self, displacement: np.ndarray):
         displacement_micron = 3.45*displacement/40
         self.mmc.setRelativeXYPosition(-displacement_micron[1], -displacement_micron[0])
+    
+    def stage_failed(self, message: str):
+        # The moves queued behind a failed one usually fail as well, show only one warning at a time
+        if self.stage_error_shown:
+            return
+        self.stage_error_shown = True
+        self.show_error(message)
+        self.stage_error_shown = False
 
     def toggle_background_subtraction(self):
         self.subtract_background = not self.subtract_background
@@ -659,24 +980,69 @@ class MainWindow(QMainWindow):
         
     
     def update_display(self, frame: np.ndarray):
-        if (self.subtract_background and self.background is not None):
-            # (reference + signal) / reference
-            diff = pc.background_subtracted(frame, self.background)
-            frame = pc.float_to_mono(diff)
-        self.new_processed_frame.emit(frame)
+        # Downstream numpy, OpenCV and QImage consumers all expect a packed frame
+        if not frame.flags['C_CONTIGUOUS']:
+            frame = np.ascontiguousarray(frame)
+        # Only process every frame when recording or snapping a processed photo
+        processed = self.isSignalConnected(self.new_processed_frame_method)
+        if processed:
+            frame = self.process_frame(frame)
+            self.new_processed_frame.emit(frame)
+        # Drawing is deferred until the queued frames are handled and the display interval has
+        # passed, so only the newest frame is shown
+        self.latest_frame = (frame, processed)
+        if not self.display_timer.isActive():
+            wait = DISPLAY_INTERVAL - (time.monotonic() - self.last_draw)
+            self.display_timer.start(max(0, int(wait*1000)))
+
+    def show_latest_frame(self):
+        self.last_draw = time.monotonic()
+        # Nothing to draw into, the next frame after restoring the window is shown instead
+        if self.isMinimized() or not self.video_view.isVisible():
+            return
+        frame, processed = self.latest_frame
+        if not processed:
+            frame = self.process_frame(frame)
         self.video_view.update_image(frame)
 
+    def select_frame_processor(self):
+        # Picked when the subtraction settings change instead of checked on every frame.
+        # The reciprocal is bound in, so a background swapped in from a worker can't be half seen.
+        reciprocal = self.background_reciprocal
+        if self._subtract_background and reciprocal is not None:
+            self.process_frame = partial(self.subtracted_frame, reciprocal)
+        else:
+            self.process_frame = self.raw_frame
+
+    def raw_frame(self, frame: np.ndarray) -> np.ndarray:
+        return frame
+
+    def subtracted_frame(self, reciprocal: np.ndarray, frame: np.ndarray) -> np.ndarray:
+        # (reference + signal) / reference
+        if self.display_buffer is None or self.display_buffer.shape != frame.shape:
+            self.display_buffer = pc.aligned_empty(frame.shape, np.uint16)
+        return pc.background_subtracted_mono(frame, reciprocal, self.display_buffer)
+
     
-    def generate_metadata(self) -> dict:
+    def cache_device_metadata(self):
+        # The camera and laser settings don't change during a sweep, read them once at the start.
+        # Called from the aquisition workers, so the laser's serial read doesn't block the GUI.
         exposure_auto = self.camera.device_property_map.get_value_bool(ic4.PropId.EXPOSURE_AUTO)
         if exposure_auto:
             exposure_time = "auto"
         else:
             exposure_time = int(self.camera.device_property_map.get_value_float(ic4.PropId.EXPOSURE_TIME))
-        return({
+        self.device_metadata = {
             "Camera.fps": self.camera.device_property_map.get_value_float(ic4.PropId.ACQUISITION_FRAME_RATE),
             "Camera.exposure_time [us]": exposure_time,
-            "Laser.wavelength [nm]": self.laser.wavelen,
-            "Laser.bandwith [nm]": self.laser.bandwith,
             "Laser.frequency [kHz]": self.laser.get_frequency()
+        }
+    
+    def generate_metadata(self) -> dict:
+        if self.device_metadata is None:
+            self.cache_device_metadata()
+        return({
+            **self.device_metadata,
+            "Laser.wavelength [nm]": float(self.laser.wavelen),
+            "Laser.bandwith [nm]": self.laser.bandwith
         })
\ No newline at end of file
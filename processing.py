@@ -1,23 +1,164 @@
+import math
 import numpy as np
+from numba import config, njit, prange, get_num_threads
 
-def background_subtracted(data, background):
-    diff = np.divide(np.subtract(data, background, dtype=np.int32), background, dtype=np.float64)
-    return diff
-
-def float_to_mono(data):
-    data = np.clip(data, -1, 1)
-    return ((data+1)*32767).astype(np.uint16)
-
-
-def common_background(backgrounds):
-    output_weights = np.zeros_like(backgrounds, dtype=np.float64)
-    for i in range(len(backgrounds)):
-        for j in range(len(backgrounds)):
-            if (i < j):
-                diff = np.divide(np.subtract(backgrounds[i], backgrounds[j], dtype=np.int32), backgrounds[j], dtype=np.float64)
-                weight = np.exp(-np.abs(diff)/0.1)
-                output_weights[i] = np.maximum(weight, output_weights[i])
-                output_weights[j] = np.maximum(weight, output_weights[j])
-    
-    
-    return np.average(backgrounds, axis=0, weights=output_weights).astype(backgrounds[0].dtype)
\ No newline at end of file
+# The parallel kernels are called from the GUI thread and the aquisition, save and warm up
+# workers at the same time, which the default workqueue layer aborts on. Has to be set before
+# the first parallel call, threadsafe picks TBB or OpenMP.
+config.THREADING_LAYER = 'threadsafe'
+
+def launch_threads():
+    # Load the threading layer from the calling thread. Started first from a worker thread,
+    # TBB keeps the process from exiting.
+    get_num_threads()
+
+def background_subtracted_to_mono(data, background, out=None):
+    # (data - background)/background, clipped to [-1, 1] and scaled to uint16 as (x + 1)*32767,
+    # in one float64 pass without int32 and float64 temporaries
+    if data.shape != background.shape:
+        raise ValueError(f"Shape mismatch: data {data.shape}, background {background.shape}")
+    if out is None:
+        out = np.empty(data.shape, dtype=np.uint16)
+    _background_subtracted_to_mono(np.ascontiguousarray(data).reshape(-1), np.ascontiguousarray(background).reshape(-1), out.reshape(-1))
+    return out
+
+@njit(parallel=True, cache=True, error_model='numpy')
+def _background_subtracted_to_mono(data, background, out):
+    for i in prange(data.size):
+        reference = np.float64(background[i])
+        diff = (np.float64(np.int32(data[i]) - np.int32(background[i])))/reference
+        diff = min(max(diff, -1.0), 1.0)
+        out[i] = np.uint16((diff + 1)*32767)
+
+def aligned_empty(shape, dtype, align=64):
+    # np.empty starting on an align byte boundary, so vectorised loops need no unaligned head
+    dtype = np.dtype(dtype)
+    nbytes = math.prod(shape)*dtype.itemsize
+    raw = np.empty(nbytes + align, dtype=np.uint8)
+    offset = -raw.ctypes.data % align
+    return raw[offset:offset + nbytes].view(dtype).reshape(shape)
+
+def background_reciprocal(background):
+    # 1/background, computed once per background so the live kernel multiplies instead of divides
+    reciprocal = aligned_empty(background.shape, np.float32)
+    with np.errstate(divide='ignore'):
+        return np.divide(1, background, out=reciprocal, dtype=np.float32)
+
+def background_subtracted_mono(data, reciprocal, out):
+    # Like background_subtracted_to_mono for the live display, in float32 and written into out.
+    # reciprocal is background_reciprocal(background)
+    if data.shape != reciprocal.shape or data.shape != out.shape:
+        raise ValueError(f"Shape mismatch: data {data.shape}, background {reciprocal.shape}, out {out.shape}")
+    _background_subtracted_mono(data.reshape(-1), reciprocal.reshape(-1), out.reshape(-1))
+    return out
+
+@njit(parallel=True, fastmath=True, cache=True, error_model='numpy')
+def _background_subtracted_mono(data, reciprocal, out):
+    for i in prange(data.size):
+        # (data - background)/background without a division per pixel
+        diff = np.float32(data[i])*reciprocal[i] - np.float32(1)
+        diff = min(max(diff, np.float32(-1)), np.float32(1))
+        out[i] = np.uint16((diff + 1)*32767)
+
+def mono16_to_mono8(data, out):
+    # The high byte of each pixel, written into out, for showing or encoding 16 bit frames
+    if data.shape != out.shape:
+        raise ValueError(f"Shape mismatch: data {data.shape}, out {out.shape}")
+    _mono16_to_mono8(data.reshape(-1), out.reshape(-1))
+    return out
+
+@njit(parallel=True, cache=True)
+def _mono16_to_mono8(data, out):
+    for i in prange(data.size):
+        out[i] = np.uint8(data[i] >> 8)
+
+def warm_up():
+    # Compile (or load from the cache) the kernels for both camera pixel types up front,
+    # so the first subtracted frame or background doesn't stall on the JIT
+    for dtype in (np.uint8, np.uint16):
+        frame = np.ones((2, 2, 1), dtype=dtype)
+        background_subtracted_mono(frame, background_reciprocal(frame), np.empty(frame.shape, dtype=np.uint16))
+        background_subtracted_to_mono(frame, frame)
+        mono16_to_mono8(frame.astype(np.uint16), np.empty(frame.shape, dtype=np.uint8))
+        common_background(np.stack((frame, frame)))
+
+
+def common_background(backgrounds, axis=0, out=None):
+    # The backgrounds are stacked along axis, other axes are processed in one go.
+    # Viewed as (leading, backgrounds, trailing) so the stack is read in place whatever the axis.
+    backgrounds = np.ascontiguousarray(backgrounds)
+    axis = axis % backgrounds.ndim
+    shape = backgrounds.shape[:axis] + backgrounds.shape[axis + 1:]
+    stack = backgrounds.reshape(math.prod(backgrounds.shape[:axis]), backgrounds.shape[axis], math.prod(backgrounds.shape[axis + 1:]))
+    # The result is written directly, only one block of float64 weights is kept
+    if out is not None and out.flags['C_CONTIGUOUS'] and out.shape == shape and out.dtype == backgrounds.dtype:
+        background = out
+    else:
+        background = np.empty(shape, dtype=backgrounds.dtype)
+    # The exponents come from Numba, but np.exp turns them into weights so the result matches
+    # NumPy's exp bit for bit. Done per block of pixels so the float64 weights stay bounded,
+    # more backgrounds mean fewer pixels per block.
+    n = stack.shape[1]
+    size = stack.shape[0]*stack.shape[2]
+    block = min(max(BACKGROUND_BLOCK_WEIGHTS // n, 16), size)
+    buffer = np.empty(n*block)
+    weights_sum_zero = 0
+    for first in range(0, size, block):
+        count = min(block, size - first)
+        weights = buffer[:n*count].reshape(n, count)
+        _background_exponents(stack, first, weights)
+        np.exp(weights, out=weights)
+        weights_sum_zero += _weighted_background(stack, first, weights, background.reshape(stack.shape[0], stack.shape[2]))
+    if weights_sum_zero:
+        raise ZeroDivisionError("Weights sum to zero, can't be normalized")
+    if out is None or out is background:
+        return background
+    np.copyto(out, background, casting='unsafe')
+    return out
+
+# Weights per block of common_background, 1 MB of float64. The exponents are written, passed
+# through np.exp and read back for the average, so a block stays in L2 for all three passes.
+BACKGROUND_BLOCK_WEIGHTS = 1 << 17
+
+@njit(parallel=True, cache=True, error_model='numpy')
+def _background_exponents(backgrounds, first, exponents):
+    # For count pixels of the flattened (leading, pixels) grid from first on, the best match of
+    # each background with any other one as the exponent -|b_i - b_j|/b_j/0.1 for i < j.
+    # exp is monotonic, so exp of the largest exponent is the largest weight.
+    leading, n, pixels = backgrounds.shape
+    for t in prange(exponents.shape[1]):
+        l = (first + t) // pixels
+        p = (first + t) % pixels
+        for i in range(n):
+            exponents[i, t] = -np.inf
+        # Each pair is evaluated once and updates both of its exponents
+        for i in range(n):
+            b_i = np.float64(backgrounds[l, i, p])
+            for j in range(i + 1, n):
+                b_j = np.float64(backgrounds[l, j, p])
+                e = -abs((b_i - b_j)/b_j)/0.1
+                # Like np.maximum, a nan sticks
+                if (e > exponents[i, t] or e != e) and exponents[i, t] == exponents[i, t]:
+                    exponents[i, t] = e
+                if (e > exponents[j, t] or e != e) and exponents[j, t] == exponents[j, t]:
+                    exponents[j, t] = e
+
+@njit(parallel=True, cache=True, error_model='numpy')
+def _weighted_background(backgrounds, first, weights, out):
+    # Weighted average of the backgrounds for the pixels of _background_exponents, summed in
+    # the order np.average uses. Returns the number of pixels whose weights sum to zero.
+    leading, n, pixels = backgrounds.shape
+    weights_sum_zero = 0
+    for t in prange(weights.shape[1]):
+        l = (first + t) // pixels
+        p = (first + t) % pixels
+        weighted_sum = 0.0
+        total = 0.0
+        for i in range(n):
+            weighted_sum += weights[i, t]*np.float64(backgrounds[l, i, p])
+            total += weights[i, t]
+        if total == 0:
+            weights_sum_zero += 1
+        else:
+            out[l, p] = weighted_sum/total
+    return weights_sum_zero
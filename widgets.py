@@ -1,9 +1,16 @@
-from PySide6.QtCore import QRect, QMargins, Qt, QPoint, Signal
-from PySide6.QtGui import QPixmap, QImage, QPen, QBrush
+from PySide6.QtCore import QRect, QMargins, Qt, QPoint, QPointF, QTimer, Signal
+from PySide6.QtGui import QPixmap, QImage, QPen, QBrush, QTransform, QPainter
 from PySide6.QtWidgets import QGraphicsView, QGraphicsScene, QGraphicsPixmapItem, QGraphicsRectItem, QDialog, QFormLayout, QSpinBox, QDoubleSpinBox, QVBoxLayout, QHBoxLayout, QPushButton, QDialogButtonBox
 
 import numpy as np
 
+import processing as pc
+
+
+def snap16(value: int, maximum: int) -> int:
+    # Clamp to [0, maximum] and round to the nearest multiple of 16, halves to even like np.round
+    return round(min(max(value, 0), maximum)/16)*16
+
 class SweepDialog(QDialog):
     def __init__(self, parent, title: str, limits, defaults, unit):
         super().__init__(parent=parent)
@@ -42,6 +49,8 @@ class VideoView(QGraphicsView):
     def __init__(self, parent=None):
         super().__init__(parent)
         self._scene = QGraphicsScene(self)
+        # Only three items, a BSP index would just be rebuilt on every pixmap change
+        self._scene.setItemIndexMethod(QGraphicsScene.ItemIndexMethod.NoIndex)
         self.setDragMode(QGraphicsView.ScrollHandDrag)
         
         self.camera_display = QGraphicsPixmapItem()
@@ -60,13 +69,35 @@ class VideoView(QGraphicsView):
         self.setMinimumSize(640, 480)
         self.setScene(self._scene)
         self.setTransformationAnchor(QGraphicsView.ViewportAnchor.AnchorUnderMouse)
+        # Live video of unrotated, integer pixel items, no antialiasing margins or painter state needed
+        self.setViewportUpdateMode(QGraphicsView.ViewportUpdateMode.SmartViewportUpdate)
+        self.setOptimizationFlags(QGraphicsView.OptimizationFlag.DontSavePainterState | QGraphicsView.OptimizationFlag.DontAdjustForAntialiasing)
+        self.setRenderHints(QPainter.RenderHint(0))
 
         self.zoom_factor = 1.25
         self.current_scale = 1.0
         self.start_point = None
         self.displacement_thresh = 10
+        # Stage moves are summed and sent at most once per 16 ms instead of for every mouse event
+        self.pending_displacement = QPointF()
+        self.move_stage_timer = QTimer(self)
+        self.move_stage_timer.setSingleShot(True)
+        self.move_stage_timer.setInterval(16)
+        self.move_stage_timer.timeout.connect(self.flush_displacement)
 
         self._mode = "navigation"
+        # Margins last applied by update_margins, as (width, height, background rect)
+        self.margins_key = None
+        # Geometry of the last frame as (shape, dtype, bytes per line, format)
+        self.image_layout = None
+        # 16 bit frames are shifted into this 8 bit buffer, wrapped once by display_image
+        self.display_u8: np.ndarray = None
+        self.display_image: QImage = None
+        # Packed copy of the last strided frame
+        self.contiguous_frame: np.ndarray = None
+        # 8 bit frame currently on screen and the QImage over it
+        self.shown_frame: np.ndarray = None
+        self.shown_image: QImage = None
     
     @property
     def mode(self) -> str:
@@ -90,19 +121,50 @@ class VideoView(QGraphicsView):
         self.max_roi_height = max_height
         self.background.setRect(QRect(0, 0, max_width, max_height))
         self.camera_display.setOffset(QPoint(offset_x, offset_y))
-        self.scale(0.25,0.25)
-        self.current_scale *= 0.25
-        self.update_margins()
+        self.set_scale(self.current_scale*0.25)
         self.centerOn(self.background.boundingRect().center())
         
 
     def update_image(self, frame):
-        height, width, channels = np.shape(frame)
-            
+        # QImage assumes packed rows, copy strided frames into a reused buffer first
+        if not frame.flags['C_CONTIGUOUS']:
+            if self.contiguous_frame is None or self.contiguous_frame.shape != frame.shape or self.contiguous_frame.dtype != frame.dtype:
+                self.contiguous_frame = np.empty(frame.shape, dtype=frame.dtype)
+            np.copyto(self.contiguous_frame, frame)
+            frame = self.contiguous_frame
+        layout = self.image_layout
+        if layout is None or layout[0] != frame.shape or layout[1] != frame.dtype:
+            layout = self.cache_image_layout(frame)
+        shape, dtype, bytes_per_line, format = layout
+        if self.display_image is not None:
+            # Only 8 bits are shown, so halve the data before Qt sees it
+            pc.mono16_to_mono8(frame, self.display_u8)
+            image = self.display_image
+        else:
+            # Zero copy header over the frame. Both are kept while shown, a pixmap without
+            # conversion may still refer to the frame's memory, and holding it keeps the
+            # camera's pool from reusing that frame.
+            image = QImage(frame.data, shape[1], shape[0], bytes_per_line, format)
+            self.shown_frame = frame
+            self.shown_image = image
+        # Keep the grayscale format, the conversion happens only once while drawing
+        self.camera_display.setPixmap(QPixmap.fromImage(image, Qt.ImageConversionFlag.NoFormatConversion))
+
+    def cache_image_layout(self, frame):
+        height, width, channels = frame.shape
+        self.display_u8 = None
+        self.display_image = None
+        self.shown_frame = None
+        self.shown_image = None
         if frame.dtype == np.uint16:
-            self.camera_display.setPixmap(QPixmap.fromImage(QImage(frame.data, width, height, 2*channels*width, QImage.Format_Grayscale16)))
+            self.display_u8 = np.empty(frame.shape, dtype=np.uint8)
+            self.display_image = QImage(self.display_u8.data, width, height, channels*width, QImage.Format_Grayscale8)
+            self.image_layout = (frame.shape, frame.dtype, channels*width, QImage.Format_Grayscale8)
         elif frame.dtype == np.uint8:
-            self.camera_display.setPixmap(QPixmap.fromImage(QImage(frame.data, width, height, channels*width, QImage.Format_Grayscale8)))
+            self.image_layout = (frame.shape, frame.dtype, channels*width, QImage.Format_Grayscale8)
+        else:
+            raise TypeError(f"Unsupported frame type {frame.dtype}")
+        return self.image_layout
 
         
 
@@ -127,42 +189,45 @@ class VideoView(QGraphicsView):
         """
         Zoom in by scaling up.
         """
-        self.scale(self.zoom_factor, self.zoom_factor)
-        self.current_scale *= self.zoom_factor
-        self.update_margins()
+        self.set_scale(self.current_scale*self.zoom_factor)
 
     def zoom_out(self):
         """
         Zoom out by scaling down.
         """
-        self.scale(1 / self.zoom_factor, 1 / self.zoom_factor)
-        self.current_scale /= self.zoom_factor
+        self.set_scale(self.current_scale/self.zoom_factor)
+
+    def set_scale(self, scale: float):
+        """
+        Set the absolute zoom, current_scale is the source of truth so repeated zooms don't drift.
+        """
+        self.current_scale = scale
+        self.setTransform(QTransform.fromScale(scale, scale))
         self.update_margins()
     
     def reset_zoom(self):
         """
         Reset zoom to the original scale.
         """
-        self.resetTransform()
-        self.update_margins()
-        self.current_scale = 1.0
+        self.set_scale(1.0)
     
     def get_bounds(self):
-        bounds = np.array(self.mapToScene(self.viewport().rect()).boundingRect().getCoords(), dtype=np.int16)
-        bounds[0] = max(bounds[0], 0)
-        bounds[1] = max(bounds[1], 0)
-        bounds[2] = min(bounds[2], self.camera_display.pixmap().width() - 1)
-        bounds[3] = min(bounds[3], self.camera_display.pixmap().height() - 1)
-        return bounds
+        # Clamped as plain ints, one array is built for the result
+        x1, y1, x2, y2 = self.mapToScene(self.viewport().rect()).boundingRect().getCoords()
+        pixmap = self.camera_display.pixmap()
+        return np.array((max(int(x1), 0), max(int(y1), 0), min(int(x2), pixmap.width() - 1), min(int(y2), pixmap.height() - 1)), dtype=np.int16)
     
     def update_margins(self):
         """
         Make margins of half the viewport size around the camera to enable panning up to the borders
         """
-        rect = self.mapToScene(self.viewport().rect()).boundingRect()
-        size = rect.size()
-        w = size.width() // 2
-        h = size.height() // 2
+        # The view only scales, so the visible scene size follows from the viewport without mapping it
+        w = int(self.viewport().width()/self.current_scale) // 2
+        h = int(self.viewport().height()/self.current_scale) // 2
+        key = (w, h, self.background.rect())
+        if key == self.margins_key:
+            return
+        self.margins_key = key
         m = QMargins(w, h, w, h)
         rect = self.background.rect().marginsAdded(m).toRect()
         self.setSceneRect(rect)
@@ -174,8 +239,8 @@ class VideoView(QGraphicsView):
             if self.mode == "roi":
                 # Start drawing a new rectangle
                 self.start_point = self.mapToScene(event.pos()).toPoint()
-                self.start_point.setX(np.round(np.clip(self.start_point.x(), 0, self.max_roi_width)/16)*16)
-                self.start_point.setY(np.round(np.clip(self.start_point.y(), 0, self.max_roi_height)/16)*16)
+                self.start_point.setX(snap16(self.start_point.x(), self.max_roi_width))
+                self.start_point.setY(snap16(self.start_point.y(), self.max_roi_height))
                 self.roi_graphic.show()
             if self.mode == "navigation":
                 super().mousePressEvent(event)
@@ -187,7 +252,9 @@ class VideoView(QGraphicsView):
                 displacement = current_point - self.start_point
                 if (displacement.x()**2 + displacement.y()**2) > self.displacement_thresh:
                     self.start_point = current_point
-                    self.move_stage.emit(np.array(displacement.toTuple()))
+                    self.pending_displacement += displacement
+                    if not self.move_stage_timer.isActive():
+                        self.move_stage_timer.start()
 
             if self.mode == "roi":
                 # Update the graphic
@@ -202,6 +269,8 @@ class VideoView(QGraphicsView):
             if self.start_point is not None:
                 if self.mode == "move":
                     self.start_point = None
+                    self.move_stage_timer.stop()
+                    self.flush_displacement()
                 if self.mode == "roi":
                     # Update the graphic
                     end_point = self.mapToScene(event.pos()).toPoint()
@@ -217,10 +286,15 @@ class VideoView(QGraphicsView):
                     self.camera_display.setOffset(rect.topLeft())
         return super().mouseReleaseEvent(event)
 
+    def flush_displacement(self):
+        if not self.pending_displacement.isNull():
+            self.move_stage.emit(np.array(self.pending_displacement.toTuple()))
+            self.pending_displacement = QPointF()
+
     def calculate_endpoint(self, end_point):
         # Snap to grid
-        end_point.setX(np.round(np.clip(end_point.x(), 0, self.max_roi_width)/16)*16)
-        end_point.setY(np.round(np.clip(end_point.y(), 0, self.max_roi_height)/16)*16)
+        end_point.setX(snap16(end_point.x(), self.max_roi_width))
+        end_point.setY(snap16(end_point.y(), self.max_roi_height))
 
         # Set minimum to 256
         displacement = end_point - self.start_point